@@ -6,19 +6,78 @@ import sys
 import json
 import yaml
 import yaxil
-import string
+import asyncio
+import hashlib
 import logging
 import requests
+import functools
+import itertools
+import contextlib
+import dataclasses
 import collections
 import argparse as ap
+import concurrent.futures
 from io import StringIO
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from yaml.representer import Representer
 from yaxil.exceptions import NoExperimentsError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 logger = logging.getLogger(os.path.basename(__file__))
 logging.basicConfig(level=logging.INFO)
 
-yaml.add_representer(collections.defaultdict, Representer.represent_dict)
+MAX_WORKERS = 8
+
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.2
+RETRY_STATUSES = [502, 503, 504]
+
+HTTP_CACHE_NAME = 'xnat_cache'
+
+CSX6_V1_PREFIX = 'WIP925B_'
+CSX6_V1_RE = re.compile('^' + re.escape(CSX6_V1_PREFIX) + r'\d+\.\d+mmCor_\d+_\d+_CSx6$')
+CSX6_V2_PREFIX = 'WIP19_1mmCor_'
+CSX6_V2_RE = re.compile('^' + re.escape(CSX6_V2_PREFIX) + r'\d+_\d+_CSx6(_RDS)?$')
+CSX6_VOX_RE = re.compile(r'.*_(\d+(?:\.\d+)?)mmCor_.*')
+WAVE_PREFIX = 'WIP1084C_r3x3_1mm'
+WAVE_RE = re.compile('^' + re.escape(WAVE_PREFIX) + r'(_RR)?$')
+WAVE_VOX_RE = re.compile(r'.*_(\d+)mm(_RR)?')
+DIFFB0_VOX_RE = re.compile(r'.*_(\d+)mm_.*')
+
+@dataclasses.dataclass(slots=True)
+class ScanUpdate:
+    project: str
+    subject: str
+    session: str
+    scan: str
+    modality: str
+    series_description: str
+    note: str
+    tag: str
+
+def represent_scan_update(dumper, data):
+    return dumper.represent_dict(dataclasses.asdict(data))
+
+# prefer the LibYAML emitter when PyYAML was built with it
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+yaml.add_representer(collections.defaultdict, Representer.represent_dict, Dumper=YamlDumper)
+yaml.add_representer(ScanUpdate, represent_scan_update, Dumper=YamlDumper)
 
 def main():
     parser = ap.ArgumentParser()
@@ -26,6 +85,11 @@ def main():
         help='XNAT alias')
     parser.add_argument('-c', '--cache', action='store_true',
         help='Speed up development by caching yaxil.scans output')
+    parser.add_argument('--http-cache', action='store_true',
+        help='Cache XNAT HTTP responses using requests-cache. Cached '
+             'responses are revalidated with ETag/Last-Modified, but the '
+             'scan listing may still be stale if XNAT does not update them '
+             'when a note changes')
     parser.add_argument('-o', '--output-file',
         help='Output summary of updates')
     parser.add_argument('--protocol', choices=['v1', 'v2'], default='v1',
@@ -36,121 +100,335 @@ def main():
         help='Overwrite note instead of appending')
     parser.add_argument('--dry-run', action='store_true',
         help='Do everything except change anything in XNAT')
+    parser.add_argument('--batch', action='store_true',
+        help='Send all note updates for a session in a single request')
+    parser.add_argument('--async-updates', action='store_true',
+        help='Send note updates concurrently using aiohttp (same retry '
+             'policy as the default threaded updates)')
+    parser.add_argument('-s', '--state', action='store_true',
+        help='Skip sessions whose scans are unchanged since the last run')
     parser.add_argument('session')
     args = parser.parse_args()
+
+    if args.async_updates and not aiohttp:
+        logger.critical('--async-updates requires aiohttp to be installed')
+        sys.exit(1)
     
     try:
-        scans = get_scan_listing(args.session, args.alias, args.cache)
+        scans = get_scan_listing(
+            args.session,
+            args.alias,
+            cache=args.cache,
+            http_cache=args.http_cache
+        )
     except NoExperimentsError as e:
         logger.critical(f'could not find {args.session} in {args.alias}')
         sys.exit(1)
 
-    updates = {
-        'csx6':   csx6(scans, args.protocol),
-        'wave':   wave(scans, args.protocol),
-        'adni':   adni(scans, args.protocol),
-        'diffb0': diffb0(scans, args.protocol)
-    }
+    if args.state:
+        state = scan_state(scans, args.protocol)
+        if state == load_state(args.session):
+            logger.info(f'no changes to {args.session} since last run')
+            return
+
+    updates = classify(scans, args.protocol)
 
     if not args.dry_run:
-        upsert(
+        work = upsert(
             args.alias,
             scans,
             updates,
             overwrite=args.overwrite,
-            confirm=args.confirm
+            confirm=args.confirm,
+            batch=args.batch,
+            async_updates=args.async_updates
         )
+        if work and args.http_cache:
+            clear_http_cache()
+        if args.state:
+            notes = {scan['id']: text for scan,text in work}
+            save_state(args.session, scan_state(scans, args.protocol, notes))
 
     if args.output_file:
         logger.info(f'saving {args.output_file}')
         with open(args.output_file, 'w') as fo:
-            content = yaml.dump(updates, sort_keys=False)
-            fo.write(content)
+            dump_updates(updates, fo)
+
+def dump_updates(updates, fo):
+    yaml.dump(updates, fo, Dumper=YamlDumper, sort_keys=False)
 
-def upsert(alias, scans, updates, overwrite=False, confirm=False):
-    auth = yaxil.auth(alias)
-    updates = list(squeeze(updates))
+def upsert(alias, scans, updates, overwrite=False, confirm=False, batch=False,
+           async_updates=False):
+    '''
+    Add tags to scan notes in XNAT and return the list of (scan, note) 
+    pairs that were set
+    '''
+    by_sid = dict()
+    for update in squeeze(updates):
+        sid = update.scan
+        if sid in by_sid:
+            raise UpsertError(f'found too many updates for scan {sid}')
+        by_sid[sid] = update
+    work = []
     t1w = 0
     for scan in scans:
         sid = scan['id']
-        note = scan['note']
-        update = [x for x in updates if x['scan'] == sid]
-        if not update:
+        update = by_sid.get(sid)
+        if update is None:
             continue
-        if len(update) > 1:
-            raise UpsertError(f'found too many updates for scan {sid}')
-        update = update.pop()
-        note = update['note'].strip()
-        tag = update['tag'].strip()
-        modality = update['modality'].strip()
+        note = update.note.strip()
+        tag = update.tag.strip()
+        modality = update.modality.strip()
         if modality.lower() == 't1w':
             t1w += 1
-        if tag not in note:
+        # compare whole tokens so e.g. ANAT_1.0_CSx6_a doesn't match ANAT_1.0_CSx6_ab
+        if tag not in set(note.split()):
             upsert = tag
             if note and not overwrite:
                 upsert = f'{tag} {note}'
             if modality.lower() == 't1w':
               upsert = f'{upsert} #T1w_{t1w}'
-            logger.info(f'setting note for scan {sid} to "{upsert}"')
-            if confirm:
+            work.append((scan, upsert))
+    if not work:
+        logger.info('no notes need updating')
+        return work
+    auth = xnat_auth(alias)
+    if confirm:
+        with xnat_session(auth) as session:
+            for scan,text in work:
+                logger.info(f'setting note for scan {scan["id"]} to "{text}"')
                 input('press enter to continue')
-            setnote(auth, scan, text=upsert)
+                setnote(session, auth, scan, text=text)
+        return work
+    for scan,text in work:
+        logger.info(f'setting note for scan {scan["id"]} to "{text}"')
+    if batch:
+        with xnat_session(auth) as session:
+            try:
+                setnotes(session, auth, work)
+                return work
+            except SetNoteError as e:
+                logger.warning(f'{e}, falling back to one update per scan')
+    if async_updates:
+        asyncio.run(asetnotes(auth, work))
+        return work
+    with xnat_session(auth) as session:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+            futures = [ex.submit(setnote, session, auth, scan, text=text) for scan,text in work]
+            for future in futures:
+                future.result()
+    return work
 
 class UpsertError(Exception):
     pass
 
 def squeeze(updates):
-    for _,voxels in iter(updates.items()):
-        for _,items in iter(voxels.items()):
-            for item in items:
-                yield item
+    '''
+    Flatten updates into a single list of ScanUpdate
+    '''
+    return list(itertools.chain.from_iterable(
+        items for voxels in updates.values() for items in voxels.values()
+    ))
+
+@functools.lru_cache(maxsize=4)
+def xnat_auth(alias):
+    '''
+    Return yaxil.auth for an alias, reading the credential store 
+    at most once per alias
+    '''
+    return yaxil.auth(alias)
 
-def setnote(auth, scan, text=None):
+def xnat_session(auth):
+    '''
+    Return a requests.Session for XNAT that reuses pooled connections
+    and retries transient gateway errors
+    '''
+    baseurl = auth.url.rstrip('/')
+    session = requests.Session()
+    session.auth = (auth.username, auth.password)
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=16,
+        max_retries=retry
+    )
+    session.mount(baseurl, adapter)
+    return session
+
+def setnote(session, auth, scan, text=None):
     if not text:
         text = ' '
+    url = scan_url(auth, scan)
+    params = {
+        'xnat:mrscandata/note': text
+    }
+    logger.info(f'PUT {url} params {params}')
+    r = session.put(url, params=params)
+    if r.status_code != requests.codes.OK:
+        raise SetNoteError(f'response not ok for {url}')
+
+def setnotes(session, auth, work):
+    '''
+    Set the note for several scans within the same MR session using
+    a single PUT against the experiment resource
+    '''
+    scan,_ = work[0]
     project = scan['session_project']
-    subject = scan['subject_label'] 
-    session = scan['session_label']
-    scan_id = scan['id']
+    subject = scan['subject_label']
+    session_label = scan['session_label']
     baseurl = auth.url.rstrip('/')
-    url = f'{baseurl}/data/projects/{project}/subjects/{subject}/experiments/{session}/scans/{scan_id}'
+    url = f'{baseurl}/data/projects/{project}/subjects/{subject}/experiments/{session_label}'
+    params = dict()
+    for scan,text in work:
+        if scan['session_label'] != session_label:
+            raise SetNoteError(f'cannot batch updates across sessions for {url}')
+        scan_id = scan['id']
+        params[f'xnat:mrSessionData/scans/scan[ID={scan_id}]/note'] = text or ' '
+    logger.info(f'PUT {url} params {params}')
+    r = session.put(url, params=params)
+    if r.status_code != requests.codes.OK:
+        raise SetNoteError(f'response not ok for {url}')
+
+async def asetnotes(auth, work):
+    '''
+    Set the note for several scans concurrently using aiohttp, with 
+    at most MAX_WORKERS requests in flight. Gateway errors and failed 
+    connections are retried like the requests.Session from xnat_session.
+    '''
+    connector = aiohttp.TCPConnector(limit=MAX_WORKERS)
+    basic_auth = aiohttp.BasicAuth(auth.username, auth.password)
+    async with aiohttp.ClientSession(auth=basic_auth, connector=connector) as session:
+        tasks = [asetnote(session, auth, scan, text=text) for scan,text in work]
+        # let every PUT finish before raising, like the threaded path
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+async def asetnote(session, auth, scan, text=None):
+    if not text:
+        text = ' '
+    url = scan_url(auth, scan)
     params = {
         'xnat:mrscandata/note': text
     }
     logger.info(f'PUT {url} params {params}')
-    r = requests.put(url, params=params, auth=(auth.username, auth.password))
-    if r.status_code != requests.codes.OK:
+    for attempt in range(RETRY_TOTAL + 1):
+        retry = attempt < RETRY_TOTAL
+        try:
+            async with session.put(url, params=params) as r:
+                status = r.status
+        except aiohttp.ClientConnectionError as e:
+            if not retry:
+                raise SetNoteError(f'request failed for {url}: {e}') from e
+        except aiohttp.ClientError as e:
+            raise SetNoteError(f'request failed for {url}: {e}') from e
+        else:
+            if status not in RETRY_STATUSES or not retry:
+                break
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+    if status != requests.codes.OK:
         raise SetNoteError(f'response not ok for {url}')
 
+def scan_url(auth, scan):
+    project = scan['session_project']
+    subject = scan['subject_label'] 
+    session_label = scan['session_label']
+    scan_id = scan['id']
+    baseurl = auth.url.rstrip('/')
+    return f'{baseurl}/data/projects/{project}/subjects/{subject}/experiments/{session_label}/scans/{scan_id}'
+
 class SetNoteError(Exception):
     pass
 
-def adni(scans, protocol):
+def classify(scans, protocol):
+    '''
+    Sort scans into csx6, wave, adni, and diffb0 groups keyed by 
+    voxel size using a single pass over the scan listing.
+    '''
     match protocol:
       case 'v1':
         adnifilter = adnifilter_v1
+        csx6filter = csx6filter_v1
       case 'v2':
         adnifilter = adnifilter_v2
-    scans = filter(adnifilter, scans)
-    groups = collections.defaultdict(list)
+        csx6filter = csx6filter_v2
+    updates = {
+        'csx6':   collections.defaultdict(list),
+        'wave':   collections.defaultdict(list),
+        'adni':   collections.defaultdict(list),
+        'diffb0': collections.defaultdict(list)
+    }
+    rr_num,rr_tag = 0,0
+    b0_count = 1
     for scan in scans:
-        sid = scan['id']
-        session = scan['session_label']
-        series = scan['series_description'].strip()
-        note = scan['note'].strip()
-        vox = scan['vox_x']
-        tag = f'ANAT_{vox}_ADNI'
-        groups[vox].append({
-            'project': scan['session_project'],
-            'subject': scan['subject_label'],
-            'session': session, 
-            'scan': sid,
-            'modality': 't1w',
-            'series_description': series,
-            'note': note,
-            'tag': tag
-        })
-    return groups
+        # every group requires a usable scan
+        if scan['quality'] != 'usable':
+            continue
+        if csx6filter(scan):
+            series = scan['series_description'].strip()
+            match = CSX6_VOX_RE.match(series)
+            if match:
+                groups = updates['csx6']
+                vox = float(match.group(1))
+                suffix = letter_suffix(len(groups[vox]))
+                tag = f'ANAT_{vox}_CSx6_{suffix}'
+                groups[vox].append(entry(scan, series, 't1w', tag))
+        elif wavefilter(scan):
+            series = scan['series_description'].strip()
+            match = WAVE_VOX_RE.match(series)
+            if match:
+                groups = updates['wave']
+                vox = float(match.group(1))
+                is_rr = match.group(2)
+                suffix = letter_suffix(len(groups[vox]))
+                tag = f'ANAT_{vox:.1f}_WAVE'
+                # 🤷 special handling of RR (retro-recon) scans
+                if is_rr:
+                    rr_num += 1
+                    mod = rr_num % 2
+                    rr_tag += mod
+                    if mod == 0:
+                        rr_res = '0.0'
+                    else:
+                        rr_res = '0.1'
+                    tag += f'_RR{rr_tag}_{rr_res}'
+                tag += f'_{suffix}'
+                groups[vox].append(entry(scan, series, 't1w', tag))
+        elif adnifilter(scan):
+            series = scan['series_description'].strip()
+            vox = scan['vox_x']
+            tag = f'ANAT_{vox}_ADNI'
+            updates['adni'][vox].append(entry(scan, series, 't1w', tag))
+        elif diffb0filter(scan):
+            series = scan['series_description'].strip()
+            match = DIFFB0_VOX_RE.match(series)
+            if match:
+                if b0_count > 2:
+                    raise DiffB0Error('found too many diff b0 scans')
+                vox = float(match.group(1))
+                suffix = 'Set12' if b0_count == 1 else 'Set34'
+                tag = f'DIFF_{vox:.1f}_4B0_{suffix}'
+                updates['diffb0'][vox].append(entry(scan, series, 'b0', tag))
+                b0_count += 1
+    return updates
+
+def entry(scan, series, modality, tag):
+    return ScanUpdate(
+        project=scan['session_project'],
+        subject=scan['subject_label'],
+        session=scan['session_label'],
+        scan=scan['id'],
+        modality=modality,
+        series_description=series,
+        note=scan['note'].strip(),
+        tag=tag
+    )
 
 def adnifilter_v1(x):
     allowed_series_descriptions = [
@@ -171,161 +449,160 @@ def adnifilter_v2(x):
         x['quality'] == 'usable'
     )
 
-def csx6(scans, protocol):
-    match protocol:
-      case 'v1':
-        csx6filter = csx6filter_v1
-      case 'v2':
-        csx6filter = csx6filter_v2
-    scans = filter(csx6filter, scans)
-    groups = collections.defaultdict(list)
-    for scan in scans:
-        sid = scan['id']
-        session = scan['session_label']
-        series = scan['series_description'].strip()
-        note = scan['note'].strip()
-        match = re.match(r'.*_(\d+(?:\.\d+)?)mmCor_.*', series)
-        if match:
-            vox = float(match.group(1))
-            suffix = string.ascii_lowercase[len(groups[vox])]
-            tag = f'ANAT_{vox}_CSx6_{suffix}'
-            groups[vox].append({
-                'project': scan['session_project'],
-                'subject': scan['subject_label'],
-                'session': session, 
-                'scan': sid,
-                'modality': 't1w',
-                'series_description': series,
-                'note': note,
-                'tag': tag
-            })
-    return groups
-
 def csx6filter_v1(x):
-    expr = re.compile(r'^WIP925B_\d+\.\d+mmCor_\d+_\d+_CSx6$')
-    image_type = x.get('image_type', '').encode('utf-8').decode('unicode_escape')
+    series = x['series_description']
+    # cheap literal prefix check before running the regex
+    if not series.startswith(CSX6_V1_PREFIX):
+        return False
     return (
-        expr.match(x['series_description']) and 
-        image_type == 'ORIGINAL\\PRIMARY\\M\\ND\\NORM' and
+        CSX6_V1_RE.match(series) and 
+        x['_image_type_norm'] == 'ORIGINAL\\PRIMARY\\M\\ND\\NORM' and
         x['quality'] == 'usable'
     )
 
 def csx6filter_v2(x):
-    expr = re.compile(r'^WIP19_1mmCor_\d+_\d+_CSx6(_RDS)?$')
-    image_type = x.get('image_type', '').encode('utf-8').decode('unicode_escape')
+    series = x['series_description']
+    if not series.startswith(CSX6_V2_PREFIX):
+        return False
     return (
-        expr.match(x['series_description']) and 
-        image_type == 'ORIGINAL\\PRIMARY\\M\\NONE' and
+        CSX6_V2_RE.match(series) and 
+        x['_image_type_norm'] == 'ORIGINAL\\PRIMARY\\M\\NONE' and
         x['quality'] == 'usable'
     )
 
-def wave(scans, protocol):
-    rr_num,rr_tag = 0,0
-    scans = filter(wavefilter, scans)
-    groups = collections.defaultdict(list)
-    for scan in scans:
-        sid = scan['id']
-        session = scan['session_label']
-        series = scan['series_description'].strip()
-        note = scan['note'].strip()
-        match = re.match(r'.*_(\d+)mm(_RR)?', series)
-        if match:
-            vox = float(match.group(1))
-            is_rr = match.group(2)
-            suffix = string.ascii_lowercase[len(groups[vox])]
-            tag = f'ANAT_{vox:.1f}_WAVE'
-            # 🤷 special handling of RR (retro-recon) scans
-            if is_rr:
-                rr_num += 1
-                mod = rr_num % 2
-                rr_tag += mod
-                if mod == 0:
-                    rr_res = '0.0'
-                else:
-                    rr_res = '0.1'
-                tag += f'_RR{rr_tag}_{rr_res}'
-            tag += f'_{suffix}'
-            groups[vox].append({
-                'project': scan['session_project'],
-                'subject': scan['subject_label'],
-                'session': session,
-                'scan': sid,
-                'modality': 't1w',
-                'series_description': series,
-                'note': note,
-                'tag': tag
-            })
-    return groups
-
 def wavefilter(x):
-    expr = re.compile(r'^WIP1084C_r3x3_1mm(_RR)?$')
-    image_type = x.get('image_type', '').encode('utf-8').decode('unicode_escape')
+    series = x['series_description']
+    if not series.startswith(WAVE_PREFIX):
+        return False
     return (
-        expr.match(x['series_description']) and
-        image_type == 'ORIGINAL\\PRIMARY\\M\\ND\\NORM' and
+        WAVE_RE.match(series) and
+        x['_image_type_norm'] == 'ORIGINAL\\PRIMARY\\M\\ND\\NORM' and
         x['quality'] == 'usable'
     )
 
-def diffb0(scans, protocol):
-    scans = filter(diffb0filter, scans)
-    groups = collections.defaultdict(list)
-    count = 1
-    for scan in scans:
-        sid = scan['id']
-        session = scan['session_label']
-        series = scan['series_description'].strip()
-        note = scan['note'].strip()
-        match = re.match(r'.*_(\d+)mm_.*', series)
-        if match:
-            if count > 2:
-                raise DiffB0Error('found too many diff b0 scans')
-            vox = float(match.group(1))
-            suffix = 'Set12' if count == 1 else 'Set34'
-            tag = f'DIFF_{vox:.1f}_4B0_{suffix}'
-            groups[vox].append({
-                'project': scan['session_project'],
-                'subject': scan['subject_label'],
-                'session': session,
-                'scan': sid,
-                'modality': 'b0',
-                'series_description': series,
-                'note': note,
-                'tag': tag
-            })
-            count += 1
-    return groups
-
 def diffb0filter(x):
     return (
         x['series_description'] == 'CMRR_DiffPA_2mm_4b0' and
         x['quality'] == 'usable'
     )
 
-def get_scan_listing(session, alias='cbscentral', cache=False):
+def get_scan_listing(session, alias='cbscentral', cache=False, http_cache=False):
     '''
     Return scan listing as a list of dictionaries. 
     
     This function attempts to read the scan listing from a 
     cached JSON file. However, if a cached file doesn't exist, 
     one will be created by saving the output from yaxil.scans.
+    Passing http_cache=True will additionally cache the underlying 
+    XNAT responses with requests-cache.
+
+    Each scan is given an '_image_type_norm' key holding the decoded 
+    image_type so filters don't have to decode it repeatedly.
     '''
     cachefile = f'{session}.json'
     scans = None
     if not os.path.exists(cachefile):
         logger.info(f'cache miss {cachefile}')
-        auth = yaxil.auth(alias)
-        scans = list(yaxil.scans(auth, label=session))
+        with xnat_http_cache(http_cache):
+            auth = xnat_auth(alias)
+            scans = list(yaxil.scans(auth, label=session))
         if cache:
-            with open(cachefile, 'w') as fo:
-                fo.write(json.dumps(scans, indent=2))
+            if orjson:
+                with open(cachefile, 'wb') as fo:
+                    fo.write(orjson.dumps(scans, option=orjson.OPT_INDENT_2))
+            else:
+                with open(cachefile, 'w') as fo:
+                    json.dump(scans, fo, indent=2)
     else:
         logger.info(f'cache hit {cachefile}')
-        with open(cachefile) as fo:
-            scans = json.loads(fo.read())
+        if orjson:
+            with open(cachefile, 'rb') as fo:
+                scans = orjson.loads(fo.read())
+        else:
+            with open(cachefile) as fo:
+                scans = json.load(fo)
+    for scan in scans:
+        image_type = scan.get('image_type', '')
+        scan['_image_type_norm'] = image_type.encode('utf-8').decode('unicode_escape')
     return scans
 
+def scan_state(scans, protocol, notes=None):
+    '''
+    Return a fingerprint of everything that affects how a session 
+    is tagged. Pass notes to override the note of individual scans 
+    e.g., with the notes that were just saved to XNAT.
+    '''
+    notes = notes or dict()
+    fingerprints = dict()
+    for scan in scans:
+        sid = scan['id']
+        note = notes.get(sid, scan['note'])
+        content = '\0'.join([
+            scan['series_description'],
+            scan.get('image_type', ''),
+            scan['quality'],
+            note.strip()
+        ])
+        fingerprints[sid] = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    return {
+        'protocol': protocol,
+        'scans': fingerprints
+    }
+
+def load_state(session):
+    statefile = f'{session}.state.json'
+    if not os.path.exists(statefile):
+        return None
+    with open(statefile) as fo:
+        return json.load(fo)
+
+def save_state(session, state):
+    statefile = f'{session}.state.json'
+    logger.info(f'saving {statefile}')
+    with open(statefile, 'w') as fo:
+        json.dump(state, fo, indent=2)
+
+def xnat_http_cache(enabled=True):
+    '''
+    Return a context manager that caches GET requests made by 
+    yaxil in a local SQLite database. Cached responses are always 
+    revalidated with the server (ETag/Last-Modified) before use and 
+    responses without validators are not cached at all.
+    '''
+    if not enabled:
+        return contextlib.nullcontext()
+    if not requests_cache:
+        logger.warning('requests-cache is not installed, not caching HTTP responses')
+        return contextlib.nullcontext()
+    return requests_cache.enabled(
+        HTTP_CACHE_NAME,
+        backend='sqlite',
+        expire_after=requests_cache.EXPIRE_IMMEDIATELY
+    )
+
+def clear_http_cache():
+    '''
+    Drop cached XNAT responses e.g., after notes have been changed
+    '''
+    if not requests_cache:
+        return
+    logger.info(f'clearing HTTP cache {HTTP_CACHE_NAME}')
+    requests_cache.CachedSession(HTTP_CACHE_NAME, backend='sqlite').cache.clear()
+
 class DiffB0Error(Exception):
     pass
 
+def letter_suffix(n):
+    '''
+    Return the n-th lowercase letter (0 = a) used to number scans 
+    that share a voxel size
+    '''
+    if n >= 26:
+        raise SuffixError(f'found too many scans for a single suffix letter ({n + 1})')
+    return chr(ord('a') + n)
+
+class SuffixError(Exception):
+    pass
+
 if __name__ == '__main__':
     main()
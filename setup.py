@@ -7,6 +7,18 @@ requires = [
     'yaxil',
 ]
 
+extras = {
+    'fast': [
+        'orjson',
+    ],
+    'cache': [
+        'requests-cache',
+    ],
+    'async': [
+        'aiohttp',
+    ],
+}
+
 test_requirements = [
 ]
 
@@ -26,5 +38,6 @@ setup(
         'scripts/madrc_tagger.py'
     ],
     install_requires=requires,
+    extras_require=extras,
     tests_require=test_requirements
 )